@@ -14,6 +14,8 @@ an open port which is a big advantage over the perl/hscript/AppTalk hook
 implementation of the past.
 """
 
+from __future__ import print_function
+
 __version__ = "$Id: __init__.py,v 1.25 2011/10/25 18:17:17 tfan Exp $"
 
 # =============================================================================
@@ -24,10 +26,9 @@ __version__ = "$Id: __init__.py,v 1.25 2011/10/25 18:17:17 tfan Exp $"
 import atexit
 import copy
 import errno        # This is the only way to get standard errno lookups
-import itertools
 import os
+import random
 import socket
-import subprocess
 import sys
 import threading
 import time
@@ -39,13 +40,42 @@ from rh.logutils import logDebug, logInfo, logWarning, createLogHandler
 import rpyc
 from rh.app.rpc import utils as rpcutils
 from rh.app.rpc import callbacks
-from rh.subprocess import Run
+
+# Parsed once, startServer copies these rather than reparsing an args list
+_DEFAULT_OPTS = rpcutils.PARSER.get_default_values()
 
 # Store all open ports by application
 _SERVERS = {}
 _OPENEDPORTS = {}
+# Reverse lookup of _OPENEDPORTS so closing a port doesn't scan every app
+_PORT_TO_APP = {}
+# Guards the registries above, servers may be started/closed from any thread
+_REGISTRY_LOCK = threading.RLock()
+# Open connections by (server, port), reused by importRemoteModules
+_CONN_CACHE = {}
+# Remote module netrefs by (server, port, module), kept with their connection
+_MODULE_CACHE = {}
+_CACHE_LOCK = threading.Lock()
+# Remote expression importing a tuple of module names in one round trip
+_BATCH_IMPORT_FMT = "tuple(__import__(name, None, None, ['*']) for name in {0!r})"
 MAX_TRIES = 8
-HOU_SLEEP_TIMES = [1, 3, 5, 10]
+# Connect/import retries back off exponentially with a little jitter so
+# clients waiting on the same app don't retry in lockstep
+RETRY_DELAY = 0.25
+RETRY_DELAY_MAX = 8.0
+RETRY_JITTER = 0.1
+# A starting Houdini can take a while to make its modules importable, so
+# module retries start higher and sum to about 19s over the default retries
+MODULE_RETRY_DELAY = 1.25
+MODULE_RETRY_DELAY_MAX = 10.0
+# Bind retries for an explicit port still held over from a restarted process
+BIND_TRIES = 5
+BIND_BACKOFF = 0.1
+BIND_BACKOFF_MAX = 2.0
+# Seconds before a probe socket operation gives up
+_BIND_TIMEOUT = 2.0
+# Seconds before a connection attempt to an rpyc server gives up
+_CONNECT_TIMEOUT = 3.0
 
 
 # =============================================================================
@@ -56,33 +86,161 @@ HOU_SLEEP_TIMES = [1, 3, 5, 10]
 #    Name: _bindPort
 #    Args: (int) port : A port number or 0 to have the kernel give us a port
 # Returns: A new port number that may be valid
-#  Raises: N/A
+#  Raises: UsedOrReservedRPCError if the port can't be bound
 #    Desc: Does a socket.bind to find a port number if 0 otherwise tries
-#          to bind to that port
+#          to bind to that port.  An explicit port that is still in use is
+#          retried up to BIND_TRIES times with exponential backoff.
 # -----------------------------------------------------------------------------
 def _bindPort(host='localhost', portNum=0):
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # Always release the probe socket, a failed bind would otherwise leak its
+    # descriptor until garbage collection
     try:
-        sock.bind((host, portNum))
-    except socket.error, sockExc:
-        raise UsedOrReservedRPCError('{0} (port {1})'.format(sockExc.strerror, portNum))
-    # getsockname() returns (IP, port)
-    port = sock.getsockname()[1]
-    sock.close()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # SO_REUSEPORT is missing on older pythons and some kernels
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        except (AttributeError, socket.error):
+            pass
+        sock.settimeout(_BIND_TIMEOUT)
+        backoff = BIND_BACKOFF
+        for tries in range(1, BIND_TRIES+1):
+            try:
+                sock.bind((host, portNum))
+                break
+            except socket.error as sockExc:
+                # Only an explicit port in use is worth waiting on, the kernel
+                # handing out port 0 rarely collides
+                if (portNum and sockExc.errno == errno.EADDRINUSE and
+                        tries < BIND_TRIES):
+                    time.sleep(backoff)
+                    backoff = min(backoff * 2, BIND_BACKOFF_MAX)
+                    continue
+                raise UsedOrReservedRPCError('{0} (port {1})'.format(sockExc.strerror, portNum))
+        # getsockname() returns (IP, port)
+        port = sock.getsockname()[1]
+    finally:
+        sock.close()
 
     return port
 
 
+# -----------------------------------------------------------------------------
+#    Name: _remoteModules
+#    Args: (Connection) connection : An open rpyc classic connection
+#          (str) server : The server hostname connection was made to
+#          (int) port : The port connection was made to
+#          (list) modules : The module names to import
+# Returns: A list of netrefs to the remote modules, in the order of modules
+#  Raises: KeyError if a module can't be found remotely
+#    Desc: Returns cached netrefs for modules from server:port if the
+#          connection that built them is still open.  The rest are imported
+#          over connection in a single round trip and cached.
+# -----------------------------------------------------------------------------
+def _remoteModules(connection, server, port, modules):
+    found = {}
+    with _CACHE_LOCK:
+        for mod in modules:
+            cached = _MODULE_CACHE.get((server, port, mod))
+            # A netref is only valid as long as the connection that made it
+            if cached is not None and not cached[0].closed:
+                found[mod] = cached[1]
+
+    missing = [mod for mod in modules if mod not in found]
+    if len(missing) > 1:
+        try:
+            found.update(zip(missing,
+                             connection.eval(_BATCH_IMPORT_FMT.format(tuple(missing)))))
+        except (KeyError, ImportError):
+            # Import one at a time below so the missing module raises
+            pass
+    for mod in missing:
+        if mod not in found:
+            found[mod] = connection.modules[mod]
+
+    with _CACHE_LOCK:
+        for mod in missing:
+            _MODULE_CACHE[(server, port, mod)] = (connection, found[mod])
+
+    return [found[mod] for mod in modules]
+
+
+# -----------------------------------------------------------------------------
+#    Name: _connect
+#    Args: (str) server : The server hostname
+#          (int) port : The port number to connect to
+# Returns: An rpyc classic connection
+#  Raises: socket.timeout if the server doesn't answer within _CONNECT_TIMEOUT
+#    Desc: Connects to an rpyc server without risking an indefinite hang and
+#          turns off Nagle on the connection.
+# -----------------------------------------------------------------------------
+def _connect(server, port):
+    try:
+        connection = rpyc.classic.connect(server, port, timeout=_CONNECT_TIMEOUT)
+    except TypeError:
+        # Older rpyc has no timeout kwarg, fall back on the default timeout
+        # and restore blocking mode once connected
+        oldTimeout = socket.getdefaulttimeout()
+        socket.setdefaulttimeout(_CONNECT_TIMEOUT)
+        try:
+            connection = rpyc.classic.connect(server, port)
+        finally:
+            socket.setdefaulttimeout(oldTimeout)
+        try:
+            connection._channel.stream.sock.settimeout(oldTimeout)
+        except AttributeError:
+            pass
+
+    # Small request/reply frames shouldn't wait on Nagle
+    try:
+        rpcutils.setNoDelay(connection._channel.stream.sock)
+    except AttributeError:
+        pass
+
+    return connection
+
+
+# -----------------------------------------------------------------------------
+#    Name: _nextDelay
+#    Args: (float) delay : The delay just slept
+#          (float) maxDelay=RETRY_DELAY_MAX : The longest delay to back off to
+# Returns: The delay to sleep before the next retry
+#  Raises: N/A
+#    Desc: Doubles delay up to maxDelay and adds some jitter.
+# -----------------------------------------------------------------------------
+def _nextDelay(delay, maxDelay=RETRY_DELAY_MAX):
+    return min(delay * 2, maxDelay) + random.uniform(0, RETRY_JITTER)
+
+
+def clearConnectionCache(port=None):
+    """Forgets cached connections and remote modules.
+
+    Args:
+        (int) port=None:
+            Only forget those made over this port, all of them if None.
+
+    Connections are not closed, callers still holding one keep it alive.
+    """
+    with _CACHE_LOCK:
+        if port is None:
+            _CONN_CACHE.clear()
+            _MODULE_CACHE.clear()
+            return
+        for cache in (_CONN_CACHE, _MODULE_CACHE):
+            for key in [key for key in cache if key[1] == port]:
+                del cache[key]
+
+
 def portFromApp(app):
     """
     Returns a port from an application metadata tag.
     """
-    if _OPENEDPORTS.has_key(app):
-        openports = _OPENEDPORTS[app].keys()
-        if len(openports) > 1:
-            logWarning('Multiple open ports for app {0} found, returning first opened...')
-        return openports[0]
+    with _REGISTRY_LOCK:
+        openports = _OPENEDPORTS.get(app)
+        if openports:
+            if len(openports) > 1:
+                logWarning('Multiple open ports for app {0} found, returning first opened...')
+            return next(iter(openports))
 
     raise RPCError('No port started for {0}'.format(app))
 
@@ -115,10 +273,11 @@ def startServer(app, port=None, quiet=True, nodup=True):
 
     # Let's not make any duplicate servers
     if nodup:
-        if _OPENEDPORTS.has_key(app) and _OPENEDPORTS[app]:
-            allports = _OPENEDPORTS[app].keys()
-            logWarning('Server already started for "{0}" on port(s): {1}'.format(app, allports))
-            return
+        with _REGISTRY_LOCK:
+            existing = _OPENEDPORTS.get(app)
+            if existing:
+                logWarning('Server already started for "{0}" on port(s): {1}'.format(app, list(existing)))
+                return
 
     serverStartTries = 1
     # If a port is not specified, specify port 0.  This causes socket.bind to
@@ -131,57 +290,71 @@ def startServer(app, port=None, quiet=True, nodup=True):
     port = _bindPort(portNum=port)
 
     # Inject our port and add dont-register
-    args = []
-    if quiet:
-        args.append('-q')
-    args.extend(('-p', str(port), '--dont-register'))
-
-    options, args = rpcutils.PARSER.parse_args(args)
+    options = copy.copy(_DEFAULT_OPTS)
+    options.port = port
+    options.quiet = bool(quiet)
+    options.auto_register = False
     options.registrar = None
     options.authenticator = None
 
     triedPorts = []
 
     # The number of allowable tries before we giveup
-    for _ in range(1, serverStartTries+1):
+    for tries in range(1, serverStartTries+1):
         try:
-            _SERVERS[port] = rpcutils.serveBgThreaded(options)
-            logDebug("Started rpyc server for '{0}' @ port {1}".format(app, port))
-            if not _OPENEDPORTS.has_key(app):
-                _OPENEDPORTS[app] = dict()
-            _OPENEDPORTS[app].setdefault(port, []).append(os.getpid())
-            return _SERVERS[port]
-        except (StandardError, socket.error):
+            server = rpcutils.serveBgThreaded(options)
+        except socket.error as sockExc:
+            if sockExc.errno not in (errno.EADDRINUSE, errno.EADDRNOTAVAIL):
+                raise
             triedPorts.append(str(port))
-            # Try again
+            # Someone took the port since _bindPort, try a fresh one
+            if tries < serverStartTries:
+                port = options.port = _bindPort()
             continue
 
+        logDebug("Started rpyc server for '{0}' @ port {1}".format(app, port))
+        with _REGISTRY_LOCK:
+            _SERVERS[port] = server
+            appPorts = _OPENEDPORTS.setdefault(app, {})
+            appPorts.setdefault(port, set()).add(os.getpid())
+            _PORT_TO_APP[port] = app
+        return server
+
     raise RPCError('Server start fail!  Tried ports: {0}'.format(', '.join(triedPorts)))
 
 
 def closeServer(port):
     """Close a particular RPC server."""
-    (threadedServer, topThread) = _SERVERS[port]
+    # Unregister under the lock but don't hold it while the server thread
+    # winds down
+    with _REGISTRY_LOCK:
+        (threadedServer, topThread) = _SERVERS.pop(port)
+        app = _PORT_TO_APP.pop(port, None)
+        if app is not None:
+            _OPENEDPORTS[app].pop(port, None)
     threadedServer.close()
     topThread.join()
-    for app in _OPENEDPORTS.keys():
-        if _OPENEDPORTS[app].has_key(port):
-            del _OPENEDPORTS[app][port]
-    del _SERVERS[port]
+    clearConnectionCache(port)
     logDebug('Successfully closed port {0}'.format(port))
 
 
 @atexit.register
 def closeAllServers():
     """Closes all RPC servers."""
-    allServerPorts = _SERVERS.keys()
+    # Snapshot the ports, closeServer removes them from _SERVERS as we go
+    with _REGISTRY_LOCK:
+        allServerPorts = tuple(_SERVERS)
 
     if not allServerPorts:
         return
 
     logInfo('Closing all RPC servers...')
     for port in allServerPorts:
-        closeServer(port)
+        try:
+            closeServer(port)
+        except KeyError:
+            # Another thread closed it in the meantime
+            continue
 
     logDebug('Stopping client cleaner thread...')
 
@@ -208,30 +381,40 @@ def importRemoteModules(port, modules=None, server='localhost', retries=5):
     Imports module names on server spawned over port.  We need to return a
     connection and the modulelist so that the connection object does not go out
     of scope which makes our modules become NoneTypes.
+
+    Connections are cached per server and port and reused by later calls until
+    closed, see clearConnectionCache().
     """
     tries = 1
+    delay = RETRY_DELAY
 
-    # Let's do a timeout thing
-    connection = None
+    # Reuse an open connection when we have one
+    cacheKey = (server, port)
+    with _CACHE_LOCK:
+        connection = _CONN_CACHE.get(cacheKey)
+    if connection is not None and connection.closed:
+        connection = None
 
-    while tries <= MAX_TRIES:
+    # Let's do a timeout thing
+    while connection is None and tries <= MAX_TRIES:
         try:
-            connection = rpyc.classic.connect(server, port)
-        except socket.timeout, sockExc:
+            connection = _connect(server, port)
+        except socket.timeout as sockExc:
             if tries < MAX_TRIES:
                 tries += 1
-                print 'Timed out, trying again...'
-                time.sleep(0.5)
+                print('Timed out, trying again...')
+                time.sleep(delay)
+                delay = _nextDelay(delay)
             else:
-                print sockExc
+                print(sockExc)
                 raise RPCConnectError('{0} (port {1})'.format(sockExc.strerror, port))
-        except IOError as (errno, strerror):
-            raise RPCConnectError("I/O error({0}): {1}".format(errno, strerror))
+        except IOError as ioExc:
+            raise RPCConnectError("I/O error({0}): {1}".format(ioExc.errno, ioExc.strerror))
         except EOFError:
             raise RPCConnectError("EOF error")
 
-        if connection:
-            break
+    with _CACHE_LOCK:
+        _CONN_CACHE[cacheKey] = connection
 
     if not modules or not isinstance(modules, list):
         raise ValueError('"modules" arg expects a list of module names!')
@@ -240,10 +423,11 @@ def importRemoteModules(port, modules=None, server='localhost', retries=5):
     if retries < 1:
         retries = 1
     houTry = 0
+    delay = MODULE_RETRY_DELAY
     while houTry < retries:
         try:
-            remoteModules = [connection.modules[mod] for mod in modules]
-        except KeyError, e:
+            remoteModules = _remoteModules(connection, server, port, modules)
+        except KeyError as e:
             if (houTry + 1) >= retries:
                 # we have run out of retries
                 # raise an error
@@ -251,12 +435,18 @@ def importRemoteModules(port, modules=None, server='localhost', retries=5):
             else:
                 # keep trying until we run out of retries
                 # sleep for some time in between tries
-                index = houTry if houTry < len(HOU_SLEEP_TIMES) else -1
-                time.sleep(HOU_SLEEP_TIMES[index])
+                time.sleep(delay)
+                delay = _nextDelay(delay, MODULE_RETRY_DELAY_MAX)
                 houTry += 1
                 continue
+        except (EOFError, socket.error):
+            # Don't hand out a broken connection next time
+            with _CACHE_LOCK:
+                if _CONN_CACHE.get(cacheKey) is connection:
+                    del _CONN_CACHE[cacheKey]
+            raise
         houTry = retries
-        
+
 
     return connection, remoteModules
 
@@ -24,6 +24,8 @@ from rh.logutils import logWarning
 # Generic error msg format
 ERR_MSG_FMT = "RPC command:\n\n'{0} -port {1}' pid ({2})\n\nfailed!  Check shell!"
 ERR_MSG_NOPORT_FMT = "RPC command:\n\n'{0}' pid ({1})\n\nfailed!  Check shell!"
+_formatErrMsg = ERR_MSG_FMT.format
+_formatErrMsgNoPort = ERR_MSG_NOPORT_FMT.format
 
 # -----------------------------------------------------------------------------
 #    Name: _buildErrMsg
@@ -35,10 +37,10 @@ ERR_MSG_NOPORT_FMT = "RPC command:\n\n'{0}' pid ({1})\n\nfailed!  Check shell!"
 # -----------------------------------------------------------------------------
 def _buildErrMsg(cmd, port, pid):
     # If we passed a port that had been opened
-    if isinstance(port, int):
-        return ERR_MSG_FMT.format(cmd, port, pid)
+    if port is not None:
+        return _formatErrMsg(cmd, port, pid)
 
-    return ERR_MSG_NOPORT_FMT.format(cmd, pid)
+    return _formatErrMsgNoPort(cmd, pid)
 
 
 def houdiniCallback(cmd, port, pid):
@@ -59,13 +61,15 @@ def defaultCallback(cmd, port, pid):
     sys.stderr.write(errMsg)
 
 
+# Application specific callbacks, anything else gets defaultCallback
+_APP_CALLBACKS = {
+    'houdini': houdiniCallback,
+}
+
+
 def findCallbackByApp(app):
     """Finds the appropriate callback by application."""
-    if app == 'houdini':
-        return houdiniCallback
-    # default callback
-    else:
-        return defaultCallback
+    return _APP_CALLBACKS.get(app, defaultCallback)
 
 
 # =============================================================================
@@ -17,9 +17,11 @@ python -c 'import rh.rpyc.server.classic as classicserver; classicserver.PARSER.
 # System imports
 import sys
 import os
+import socket
 import rpyc
 from optparse import OptionParser
 import threading
+import Queue
 
 # rpyc imports
 from rpyc.utils.server import ThreadedServer, ForkingServer
@@ -29,6 +31,8 @@ from rpyc.utils.registry import UDPRegistryClient, TCPRegistryClient
 from rpyc.utils.authenticators import VdbAuthenticator
 from rpyc.core import SlaveService
 
+# Idle handler threads kept around by PooledThreadedServer
+DEFAULT_POOL_SIZE = 8
 
 PARSER = OptionParser()
 PARSER.add_option("-m", "--mode", action="store", dest="mode", metavar="MODE",
@@ -59,10 +63,78 @@ PARSER.add_option("--registry-type", action="store", dest="regtype", type="str",
     default="udp", help="can be 'udp' or 'tcp', default is 'udp'")
 PARSER.add_option("--registry-port", action="store", dest="regport", type="int", 
     default=REGISTRY_PORT, help="the UDP/TCP port. default is %s" % (REGISTRY_PORT,))
+PARSER.add_option("--pool-size", action="store", dest="poolsize", type="int",
+    metavar="N", default=DEFAULT_POOL_SIZE, help="number of idle client threads "
+    "the background threaded server keeps for reuse. Default is %s" % (DEFAULT_POOL_SIZE,))
 PARSER.add_option("--registry-host", action="store", dest="reghost", type="str", 
     default=None, help="the registry host machine. for UDP, the default is "
     "255.255.255.255; for TCP, a value is required")
 
+def setNoDelay(sock):
+    """Disables Nagle's algorithm on sock so small rpyc frames go out at once."""
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except socket.error:
+        # Not a TCP socket (unix domain, etc.)
+        pass
+
+
+class NoDelayThreadedServer(ThreadedServer):
+    """ThreadedServer that sets TCP_NODELAY on every accepted connection."""
+    def _authenticate_and_serve_client(self, sock):
+        setNoDelay(sock)
+        ThreadedServer._authenticate_and_serve_client(self, sock)
+
+
+class PooledThreadedServer(NoDelayThreadedServer):
+    """NoDelayThreadedServer that reuses client threads between connections.
+
+    Up to poolSize idle threads are kept waiting for the next client instead of
+    starting a thread per connection.  A new thread is still started when none
+    are idle so long lived connections can't starve new clients.
+    """
+    def __init__(self, *args, **kwargs):
+        self._poolSize = kwargs.pop('poolSize', DEFAULT_POOL_SIZE)
+        self._clients = Queue.Queue()
+        self._poolLock = threading.Lock()
+        self._idleWorkers = 0
+        self._poolClosed = False
+        NoDelayThreadedServer.__init__(self, *args, **kwargs)
+
+    def _accept_method(self, sock):
+        with self._poolLock:
+            spawn = not self._idleWorkers
+            if not spawn:
+                self._idleWorkers -= 1
+        self._clients.put(sock)
+        if spawn:
+            worker = threading.Thread(target=self._serveClients)
+            worker.setDaemon(True)
+            worker.start()
+
+    def _serveClients(self):
+        """Serves queued clients until the pool has enough idle threads."""
+        while True:
+            sock = self._clients.get()
+            if sock is None:
+                return
+            self._authenticate_and_serve_client(sock)
+            with self._poolLock:
+                # Nobody will wake us once the server has closed
+                if self._poolClosed or self._idleWorkers >= self._poolSize:
+                    return
+                self._idleWorkers += 1
+
+    def close(self):
+        NoDelayThreadedServer.close(self)
+        # Wake up the idle threads so they can exit, busy ones exit when done
+        with self._poolLock:
+            self._poolClosed = True
+            idle, self._idleWorkers = self._idleWorkers, 0
+        for _ in range(idle):
+            self._clients.put(None)
+
+
 def getOptions():
     """Parses options for our various servers."""
     options, args = PARSER.parse_args()
@@ -99,10 +171,10 @@ def getOptions():
 
 def serveBgThreaded(options):
     """Starts a background threaded server.  This is what you want in most cases."""
-    ts = ThreadedServer(SlaveService, hostname = options.host,
+    ts = PooledThreadedServer(SlaveService, hostname = options.host,
          port = options.port, reuse_addr = True,
          authenticator = options.authenticator, registrar = options.registrar,
-         auto_register = options.auto_register)
+         auto_register = options.auto_register, poolSize = options.poolsize)
     ts.logger.quiet = options.quiet
     if options.logfile:
         ts.logger.console = open(options.logfile, "w")
@@ -114,7 +186,7 @@ def serveBgThreaded(options):
 
 def serveThreaded(options):
     """Starts a threaded server."""
-    t = ThreadedServer(SlaveService, hostname = options.host,
+    t = NoDelayThreadedServer(SlaveService, hostname = options.host,
         port = options.port, reuse_addr = True,
         authenticator = options.authenticator, registrar = options.registrar,
         auto_register = options.auto_register)
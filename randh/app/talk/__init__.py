@@ -11,6 +11,9 @@ Classes:
     Session - Factory class creates appropriate type based on supplied args.
     SessionError - Exception class for session errors.
 
+Functions:
+    commandMany - Send commands to several sessions and wait on them together.
+
 This module is used to create pipe or socket connections between applications.  
 You create a Session() object and pass commands into it. 
 
@@ -32,6 +35,11 @@ Here's an example of how to create a pipe to a voodoo file.
     s.command('write myfile.vdu')
     s.close()
 
+Sessions are also context managers which close on exit.
+
+    with Session(command='/usr/apps/bin/hscript', language='hscript') as s:
+        dir = s.command('oppwd')
+
 Here's an example of how to open a pipe to hscript.
 
     from rh.app.talk import Session
@@ -69,6 +77,34 @@ Here's an example of how to create a socket connection to an hscript app
 
 """
 
+import os
+import re
+import select
+import shlex
+import socket
+import subprocess
+import time
+from collections import OrderedDict
+
+# fcntl is only used to grow pipe buffers, which only linux supports
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# most bytes read from a session at a time
+_CHUNK_SIZE = 65536
+
+# line terminator searched for in session output
+_NEWLINE = b'\n'
+
+# write buffer size for socket sessions
+_WRITE_BUFSIZE = 65536
+
+# capacity requested for a file session's output pipe
+_PIPE_SIZE = 1 << 20
+_F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+
 # =============================================================================
 # BASE CLASS 
 # =============================================================================
@@ -80,12 +116,20 @@ class SessionBase(object):
         (bool) echoCmd: If true, print cmd to stdout before sending to app.
         (string) lastCmd: The last command sent to the application.
         (string) lastResponse: The last response from the application.
+        (int) cacheHits: Number of cacheable commands answered from the cache.
+        (int) cacheMisses: Number of cacheable commands sent to the app.
     
     The SessionBase object provides a base class with functionality common to
     all Session objects.  
     
     """
 
+    # most responses kept for commands sent with cacheable=True
+    _CACHE_SIZE = 512
+
+    # default seconds to wait for a launched application to answer
+    _STARTUP_TIMEOUT = 30.0
+
     # str used when checking if the application is done sending a response
     _DONE_STR = 'DONEXXX' #pylint: disable=W0511
 
@@ -117,49 +161,64 @@ class SessionBase(object):
     def _validateCommonArgs(self, args):
         # ---- echo - default is False
 
-        if 'echo' in args.keys():
-            if args['echo']:
-                self.echo = True
-            else:
-                self.echo = False
-        else:
-            self.echo = False
+        self.echo = bool(args.get('echo', False))
 
         # ---- echoCmd - default is False
 
-        if 'echoCmd' in args.keys():
-            if args['echoCmd']:
-                self.echoCmd = True
-            else:
-                self.echoCmd = False
-        else:
-            self.echoCmd = False
+        self.echoCmd = bool(args.get('echoCmd', False))
 
         # ---- language - required
 
-        if 'language' in args.keys():
-
-            # make sure the supplied language is supported
-            if args['language'] in self.__class__._LANGUAGE_INFO.keys():
-                self._language = args['language']     
-            else:
-                raise SessionError('Supplied language is unknown.')
-        else:
+        try:
+            self._language = args['language']
+        except KeyError:
             raise SessionError('All sessions require a language.')
 
+        # make sure the supplied language is supported
+        if self._language not in self.__class__._LANGUAGE_INFO:
+            raise SessionError('Supplied language is unknown.')
+
+        # look up what gets sent and matched per command once up front
+        info = self.__class__._LANGUAGE_INFO[self._language]
+        self._doneCmd = info['done']
+        self._quitCmd = info['quit']
+        self._doneStrBytes = self.__class__._DONE_STR.encode()
+
         # ---- reader - required
-            
-        if 'reader' in args.keys():
+
+        try:
             self._reader = args['reader']
-        else:
+        except KeyError:
             raise SessionError('No file reader supplied to constructor.')
 
         # ---- writer - required
 
-        if 'writer' in args.keys():
+        try:
             self._writer = args['writer']
-        else:
+        except KeyError:
             raise SessionError('No file writer supplied to constructor.')
+
+        # ---- startupTimeout - optional, None waits forever
+
+        startupTimeout = args.get('startupTimeout',
+                                  self.__class__._STARTUP_TIMEOUT)
+        if startupTimeout is None:
+            self._startupTimeout = None
+        else:
+            try:
+                self._startupTimeout = float(startupTimeout)
+            except (TypeError, ValueError):
+                raise SessionError('Supplied startupTimeout is not a number.')
+
+        # ---- mutating - optional, default is None
+
+        if args.get('mutating') is not None:
+            try:
+                self._mutating = re.compile(args['mutating'])
+            except (re.error, TypeError):
+                raise SessionError('Supplied mutating pattern is invalid.')
+        else:
+            self._mutating = None
             
     def __init__(self, args):
         """Initialize a SessionBase object with the supplied arguments.
@@ -171,6 +230,12 @@ class SessionBase(object):
                 language=(str): Required language of the commands.
                 reader=(file): Required file handle for reading.
                 writer=(file): Required file handle for writing. 
+                mutating=(str): Optional regex matching commands that change
+                    the application's state and so invalidate cached
+                    responses.  By default any non-cacheable command does.
+                startupTimeout=(float): Optional seconds to wait for the
+                    application to answer after connecting.  Default is 30,
+                    None waits forever.
 
         Raises:
             SessionError: Raised when any of the following criteria is met:
@@ -180,6 +245,7 @@ class SessionBase(object):
                 * Supplied language is unsupported
                 * Problem communicating with the session.
                 * Failure to receive output from the session
+                * No answer from the session within startupTimeout
         
         Initializes a SessionBase object based on the supplied argument 
         dictionary.  The dictionary must contain a file handle for reading, 
@@ -189,10 +255,25 @@ class SessionBase(object):
 
         # set up some defaults for our instance attributes
         self._language = None
+        self._doneCmd = None
+        self._quitCmd = None
+        self._doneStrBytes = None
         self._reader = None
         self._writer = None
         self.echo = False
         self.echoCmd = False
+        self._mutating = None
+        self._startupTimeout = None
+
+        # responses to cacheable commands, least recently used first
+        self._cache = OrderedDict()
+        self.cacheHits = 0
+        self.cacheMisses = 0
+
+        # output read from the session but not yet returned, and how far
+        # into it we've already looked for the done string
+        self._recvBuf = bytearray()
+        self._recvScanned = 0
 
         self._validateCommonArgs(args)
 
@@ -201,8 +282,9 @@ class SessionBase(object):
         self.lastResponse = None
 
         # launching an app can send data to stdout or stderr.  
-        # go ahead and receive all that output and forget about it
-        self._receive()
+        # go ahead and receive all that output and forget about it, but
+        # don't hang forever on an app that never answers
+        self._receive(timeout=self._startupTimeout, keep=False)
         
     # -------------------------------------------------------------------------
     #    Name: _preCommand()
@@ -219,11 +301,12 @@ class SessionBase(object):
     #    Name: _postCommand()
     #    Args: (str) cmd - command string
     #          (str) output - output printed as a result of cmd
+    #          (bool) cacheable - whether output may be reused for cmd
     # Returns: n/a
     #  Raises: n/a
     #    Desc: Handle tasks common to all sessions after command is executed.
     # -------------------------------------------------------------------------
-    def _postCommand(self, cmd, output):
+    def _postCommand(self, cmd, output, cacheable=False):
         if self.echo:
             print output
 
@@ -231,6 +314,17 @@ class SessionBase(object):
         self.lastCmd = cmd
         self.lastResponse = output
 
+        # keep cacheable responses as the most recently used, anything else
+        # may have changed the application's state
+        if cacheable:
+            key = (self._language, cmd)
+            self._cache.pop(key, None)
+            self._cache[key] = output
+            if len(self._cache) > self.__class__._CACHE_SIZE:
+                self._cache.popitem(last=False)
+        elif self._mutating is None or self._mutating.search(cmd):
+            self._cache.clear()
+
     # -------------------------------------------------------------------------
     #    Name: _send()
     #    Args: (str) cmd - command string
@@ -244,67 +338,190 @@ class SessionBase(object):
             raise SessionError('Session has closed unexpectedly.')
         
         # attempt the write
-        try: 
-            self._writer.write("%s\n" % (cmd))
-        except IOError as (_, errMsg):
-            raise SessionError('Failed to write to application: %s' % (errMsg))
+        try:
+            self._write(cmd + '\n')
+        except (IOError, OSError) as exc:
+            raise SessionError('Failed to write to application: %s' %
+                               (exc.strerror or exc))
+
+    # -------------------------------------------------------------------------
+    #    Name: _write()
+    #    Args: (str) data - bytes to hand to the session
+    # Returns: n/a
+    #  Raises: IOError, OSError
+    #    Desc: Write all of the supplied data to the session and flush it.
+    # -------------------------------------------------------------------------
+    def _write(self, data):
+        self._writer.write(data)
 
-        # must call flush for file objects from socket.makefile() 
+        # must call flush for file objects from socket.makefile()
+        self._writer.flush()
+
+    # -------------------------------------------------------------------------
+    #    Name: _readChunk()
+    #    Args: n/a
+    # Returns: (str) data - output from the session, empty at end of file
+    #  Raises: IOError, OSError
+    #    Desc: Read whatever output the session has available, up to
+    #          _CHUNK_SIZE bytes.  Readers without a file descriptor are read
+    #          a line at a time.
+    # -------------------------------------------------------------------------
+    def _readChunk(self):
         try:
-            self._writer.flush()
-        except:
-            raise SessionError('Problem communicating with session')
+            fd = self._reader.fileno()
+        except (AttributeError, IOError, ValueError):
+            return self._reader.readline()
+
+        # os.read returns as soon as anything is available, unlike the file
+        # object's read() which blocks until it has the full size
+        return os.read(fd, _CHUNK_SIZE)
 
     # -------------------------------------------------------------------------
     #    Name: _receive()
-    #    Args: n/a
-    # Returns: (str) output
+    #    Args: (str) prelude - optional commands to send ahead of the done
+    #          command in the same write
+    #          (float) timeout - optional seconds to wait for the response
+    #          (bool) keep - if false the output is thrown away unbuilt
+    # Returns: (str) output - empty if not kept
     #  Raises: SessionError
     #    Desc: Receive output from the session.
     # -------------------------------------------------------------------------
-    def _receive(self):
-        doneStr = self.__class__._DONE_STR
-        doneCmd = self.__class__._LANGUAGE_INFO[self._language]['done']
-
+    def _receive(self, prelude=None, timeout=None, keep=True):
         # send the command to mark the end of our commands.
-        self._send(doneCmd)
+        if prelude is None:
+            self._send(self._doneCmd)
+        else:
+            self._send('%s\n%s' % (prelude, self._doneCmd))
 
-        output = ''
+        if timeout is None:
+            return self._readResponse(keep=keep)
 
-        while True:
+        return self._readResponse(deadline=time.time() + timeout, keep=keep)
 
-            # make sure the file is still open
-            if self._reader.closed:
-                raise SessionError('Session has closed unexpectedly.')
+    # -------------------------------------------------------------------------
+    #    Name: _fillBuffer()
+    #    Args: (float) deadline - optional time.time() to give up waiting at
+    # Returns: n/a
+    #  Raises: SessionError
+    #    Desc: Read the next chunk of output from the session into the buffer.
+    #          Readers without a file descriptor can't honour the deadline.
+    # -------------------------------------------------------------------------
+    def _fillBuffer(self, deadline=None):
+        # make sure the file is still open
+        if self._reader.closed:
+            raise SessionError('Session has closed unexpectedly.')
 
-            # read a line from the reader file handle
-            try: 
-                line = self._reader.readline()
-            except IOError as (_, errMsg):
-                raise SessionError('Failed to read from application: %s' % 
-                                   (errMsg))
-            
-            # TODO - deal with hscript stuff from AppTalk.pm
-
-            # we've hit the end of the commands, process appropriately
-            if doneStr in line:
-                # strip off the done string and any newlines, then add the 
-                # rest to the output as long as its not empty
-                line = line.replace(doneStr, '')
-                line = line.rstrip()
-                if line is not '':
-                    output += line
-                break
-            else:
+        # wait for output no longer than the deadline allows
+        if deadline is not None:
+            try:
+                fd = self._reader.fileno()
+            except (AttributeError, IOError, ValueError):
+                fd = None
+            if fd is not None:
+                ready, _, _ = select.select([fd], [], [],
+                                            max(0, deadline - time.time()))
+                if not ready:
+                    raise SessionError('Timed out waiting for session output.')
+
+        # read the next chunk from the reader file handle
+        try: 
+            chunk = self._readChunk()
+        except (IOError, OSError) as exc:
+            raise SessionError('Failed to read from application: %s' % 
+                               (exc.strerror or exc))
+
+        # end of file, the application went away
+        if not chunk:
+            raise SessionError('Session has closed unexpectedly.')
+
+        self._recvBuf += chunk
+
+    # -------------------------------------------------------------------------
+    #    Name: _extractResponse()
+    #    Args: (bool) keep - if false the output is dropped without copying
+    #          it out of the buffer
+    # Returns: (str) output - or None if the buffer has no full response yet,
+    #          empty if not kept
+    #  Raises: n/a
+    #    Desc: Take the output up to the line with the next done string out
+    #          of the buffer.  Anything past that line is left for the next
+    #          call.
+    # -------------------------------------------------------------------------
+    def _extractResponse(self, keep=True):
+        doneStr = self._doneStrBytes
+        buf = self._recvBuf
+
+        # look for the done string, then for the end of its line
+        doneIdx = buf.find(doneStr, self._recvScanned)
+        if doneIdx < 0:
+            # the done string may straddle the next chunk
+            self._recvScanned = max(0, len(buf) - len(doneStr) + 1)
+            return None
+        lineEnd = buf.find(_NEWLINE, doneIdx + len(doneStr))
+        if lineEnd < 0:
+            self._recvScanned = doneIdx
+            return None
+
+        # nobody wants this response, skip building it
+        if not keep:
+            del buf[:lineEnd + 1]
+            self._recvScanned = 0
+            return ''
+
+        # TODO - deal with hscript stuff from AppTalk.pm
+
+        # everything before the line with the done string is output.  the
+        # done commands echo it at the start of a line, so usually that's
+        # all there is to it
+        doneEnd = doneIdx + len(doneStr)
+        if doneIdx == 0 or buf[doneIdx - 1] == ord(_NEWLINE):
+            lineStart = doneIdx
+        else:
+            lineStart = buf.rfind(_NEWLINE, 0, doneIdx) + 1
+        output = bytes(buf[:lineStart])
+
+        # otherwise strip off the done string and any newlines from that
+        # line, then add the rest to the output as long as its not empty
+        if lineStart != doneIdx or buf[doneEnd:lineEnd].strip():
+            line = bytes(buf[lineStart:lineEnd]).replace(doneStr, '').rstrip()
+            if line:
                 output += line
 
+        del buf[:lineEnd + 1]
+        self._recvScanned = 0
+
         return output
 
-    def command(self, cmd):
+    # -------------------------------------------------------------------------
+    #    Name: _readResponse()
+    #    Args: (float) deadline - optional time.time() to give up waiting at
+    #          (bool) keep - if false the output is thrown away unbuilt
+    # Returns: (str) output - empty if not kept
+    #  Raises: SessionError
+    #    Desc: Read output from the session up to the next done string.
+    #          Output is read in chunks into a buffer until the line with the
+    #          done string arrives.  Anything read past that line is kept for
+    #          the next call.
+    # -------------------------------------------------------------------------
+    def _readResponse(self, deadline=None, keep=True):
+        # bind the methods once, large responses go around this loop a lot
+        extractResponse = self._extractResponse
+        fillBuffer = self._fillBuffer
+
+        output = extractResponse(keep)
+        while output is None:
+            fillBuffer(deadline)
+            output = extractResponse(keep)
+
+        return output
+
+    def command(self, cmd, cacheable=False):
         """Send the supplied command to the Session.
 
         Args:
             (str) cmd: The command to execute in the session.
+            (bool) cacheable: If true, return the response from the last time
+                cmd was sent when no mutating command has been sent since.
 
         Raises:
             SessionError: Raised when any of the following criteria is met:
@@ -317,18 +534,75 @@ class SessionBase(object):
         a newline character to the command.  Handles echoing the command and
         the output if the appropriate instance attributes are set to True.
 
+        Only pass cacheable=True for queries that don't change the state of
+        the application.
+
         """
-        
+
+        if cacheable:
+            key = (self._language, cmd)
+            if key in self._cache:
+                self.cacheHits += 1
+                output = self._cache[key]
+                self._preCommand(cmd)
+                self._postCommand(cmd, output, cacheable)
+                return output
+            self.cacheMisses += 1
+
         self._preCommand(cmd)
-        self._send(cmd)
 
-        # read in the results of the commands
-        output = self._receive()
+        # send the command along with the done command and read in the
+        # results of the commands
+        output = self._receive(prelude=cmd)
         
-        self._postCommand(cmd, output)
+        self._postCommand(cmd, output, cacheable)
 
         return output
 
+    def commandBatch(self, cmds):
+        """Send several commands to the Session in one go.
+
+        Args:
+            (list) cmds: The commands to execute in the session, in order.
+
+        Returns:
+            (list) The output of each command, in the same order.
+
+        Raises:
+            SessionError: Raised under the same criteria as command().
+
+        Writes all the commands, each followed by the done command, with a
+        single flush and then reads back every response.  This saves a round
+        trip to the application per command compared to calling command() in
+        a loop.  Echoing and lastCmd/lastResponse behave as if each command
+        had been sent with command().
+
+        """
+
+        cmds = list(cmds)
+        if not cmds:
+            return []
+
+        doneCmd = self._doneCmd
+
+        for cmd in cmds:
+            self._preCommand(cmd)
+        self._send('\n'.join('%s\n%s' % (cmd, doneCmd) for cmd in cmds))
+
+        # read in the results of the commands
+        outputs = []
+        for cmd in cmds:
+            output = self._readResponse()
+            self._postCommand(cmd, output)
+            outputs.append(output)
+
+        return outputs
+
+    def clearCache(self):
+        """Forget all cached command responses."""
+
+        self._cache.clear()
+
     def connected(self):
         """Return True if reader and writer handles are open."""
 
@@ -337,11 +611,14 @@ class SessionBase(object):
         else:
             return False
         
-    def __del__(self):
-        """Ensure the file handles are closed on destruction."""
+    def __enter__(self):
+        """Use the session as a context manager that closes it on exit."""
 
+        return self
+
+    def __exit__(self, *exc):
         self.close()
-    
+
 
     def close(self):
         """Closes the session connections to the application."""
@@ -366,11 +643,22 @@ class FileSession(SessionBase):
     #    Desc: Validate arguments for file sessions.
     # -------------------------------------------------------------------------
     def _validateArgs(self, args):
-        # ---- command - required
+        # ---- command - required, split into an argv unless it already is
+
+        if 'command' in args:
+            command = args['command']
+        else:
+            raise SessionError('File session creation requires a command.')
 
-        if 'command' in args.keys():
-            self._command = args['command']
+        if isinstance(command, (list, tuple)):
+            self._command = list(command)
         else:
+            try:
+                self._command = shlex.split(command)
+            except ValueError as exc:
+                raise SessionError('Failed to parse command: %s' % (exc))
+
+        if not self._command:
             raise SessionError('File session creation requires a command.')
 
     def __init__(self, args):
@@ -378,50 +666,122 @@ class FileSession(SessionBase):
         
         Args:
             (dict) args: Dictionary of options for creation.  Valid keys are:
-                command=(str): Required command str to execute subprocess.
+                command=(str|list): Required command to execute subprocess.
 
         Raises:
             SessionError: Raised when any of the following criteria is met:
+                * Command string can't be parsed
                 * Failed to open pipe(s) to the subprocess
         
         Initializes a FileSession object based on the supplied argument 
-        dictionary.  The dictionary must contain a command string.
+        dictionary.  The dictionary must contain a command string or argv
+        list.  The command is run directly rather than through a shell, so a
+        string is split shell-style but pipes, redirects and other shell
+        metacharacters are not interpreted.  Pass ['/bin/sh', '-c', cmd] to
+        get a shell.
 
         """
 
-        import subprocess
-
         # set up some defaults for our instance attributes
         self._command = None
+        self._pipe = None
+        self._rfd = None
+        self._wfd = None
 
-        self._validateArgs(args)     
+        self._validateArgs(args)
 
         # open up a pipe to the supplied command.  create new pipes for 
         # stdin and stdout.  also redirect stderr to stdout so that we get 
         # that too.  voodoo, for example, outputs to both stderr and stdout
         try: 
-            pipe = subprocess.Popen(self._command, shell=True,
+            pipe = subprocess.Popen(self._command, shell=False,
                                     stdin=subprocess.PIPE, 
                                     stdout=subprocess.PIPE,
                                     stderr=subprocess.STDOUT)
-        except OSError as (_, errMsg): 
-            raise SessionError('Failed to open pipe: %s' % (errMsg))
+        except OSError as exc: 
+            raise SessionError('Failed to open pipe: %s' % (exc.strerror or exc))
+
+        # ask for a bigger output pipe so chatty apps stall less waiting on
+        # us to read.  only linux supports this, elsewhere keep the default
+        if fcntl is not None:
+            try:
+                fcntl.fcntl(pipe.stdout.fileno(), _F_SETPIPE_SZ, _PIPE_SIZE)
+            except (IOError, OSError):
+                pass
+
+        # talk to the pipes through their raw descriptors so reads and
+        # writes skip the file objects' buffering layers
+        self._rfd = pipe.stdout.fileno()
+        self._wfd = pipe.stdin.fileno()
 
         # the subprocess pipe has stdout and stdin attributes that we can use
         args['reader'] = pipe.stdout
         args['writer'] = pipe.stdin
 
-        # call the super class init with the reader and writer to populate 
-        # the common session attributes.
-        super(FileSession, self).__init__(args)
+        self._pipe = pipe
+
+        # call the super class init with the reader and writer to populate
+        # the common session attributes.  the caller never gets a session to
+        # close if that fails, so don't leave the application running
+        try:
+            super(FileSession, self).__init__(args)
+        except SessionError:
+            self._abandon()
+            raise
+
+    # -------------------------------------------------------------------------
+    #    Name: _abandon()
+    #    Args: n/a
+    # Returns: n/a
+    #  Raises: n/a
+    #    Desc: Close the pipes and kill the application after a failed start.
+    # -------------------------------------------------------------------------
+    def _abandon(self):
+        pipe = self._pipe
+
+        for handle in (pipe.stdin, pipe.stdout):
+            try:
+                handle.close()
+            except (IOError, OSError):
+                pass
+
+        if pipe.poll() is None:
+            try:
+                pipe.kill()
+            except OSError:
+                pass
+        pipe.wait()
+
+    # -------------------------------------------------------------------------
+    #    Name: _readChunk()
+    #    Args: n/a
+    # Returns: (str) data - output from the session, empty at end of file
+    #  Raises: IOError, OSError
+    #    Desc: Read whatever output is available straight from the stdout
+    #          pipe's descriptor.
+    # -------------------------------------------------------------------------
+    def _readChunk(self):
+        return os.read(self._rfd, _CHUNK_SIZE)
+
+    # -------------------------------------------------------------------------
+    #    Name: _write()
+    #    Args: (str) data - bytes to hand to the session
+    # Returns: n/a
+    #  Raises: IOError, OSError
+    #    Desc: Write all of the supplied data straight to the stdin pipe's
+    #          descriptor.  Nothing is buffered, so there is nothing to flush.
+    # -------------------------------------------------------------------------
+    def _write(self, data):
+        # os.write can come back short, keep going until it has all gone
+        while data:
+            data = data[os.write(self._wfd, data):]
 
     def close(self):
         """Quit the application and close the file session."""
     
         # send the quit command to the application if the writer is open
         if not self._writer.closed:
-            quitCmd = self.__class__._LANGUAGE_INFO[self._language]['quit']
-            self._send(quitCmd)
+            self._send(self._quitCmd)
 
         # make sure the file handles are closed
         super(FileSession, self).close()
@@ -432,6 +792,11 @@ class FileSession(SessionBase):
 class PortSession(SessionBase):
     """Connect to a port for sending/receiving commands to an app."""
 
+    # default kernel socket buffer sizes, big enough that bursts of output
+    # from the app don't stall it while we catch up
+    _RCVBUF = 4 << 20
+    _SNDBUF = 1 << 20
+
     # -------------------------------------------------------------------------
     #    Name: _validateArgs()
     #    Args: (dict) args
@@ -442,7 +807,7 @@ class PortSession(SessionBase):
     def _validateArgs(self, args):
         # ---- port - required as an int
 
-        if 'port' in args.keys():
+        if 'port' in args:
             
             # ensure port is an integer
             try:
@@ -456,11 +821,19 @@ class PortSession(SessionBase):
 
         # ---- host - optional, defaults to 'localhost'
 
-        if 'host' in args.keys():
+        if 'host' in args:
             self.host = args['host']
         else:
             self.host = 'localhost'
 
+        # ---- rcvbuf/sndbuf - optional socket buffer sizes as ints
+
+        try:
+            self._rcvbuf = int(args.get('rcvbuf', self.__class__._RCVBUF))
+            self._sndbuf = int(args.get('sndbuf', self.__class__._SNDBUF))
+        except (TypeError, ValueError):
+            raise SessionError('Supplied socket buffer size is not an integer.')
+
     def __init__(self, args):
         """Initialize a PortSession object with the supplied arguments.
         
@@ -468,43 +841,104 @@ class PortSession(SessionBase):
             (dict) args: Dictionary of options for creation.  Valid keys are:
                 host=(str): Optional connection host.  Default is localhost
                 port=(int): Required port number on the host.
+                rcvbuf=(int): Optional socket receive buffer size in bytes.
+                    Default is 4MiB.
+                sndbuf=(int): Optional socket send buffer size in bytes.
+                    Default is 1MiB.
 
         Raises:
             SessionError: Raised when any of the following criteria is met:
                 * No port supplied
                 * Supplied port is not an integer
+                * Supplied socket buffer size is not an integer
                 * Failed to connect to host:port
         
         Initializes a FileSession object based on the supplied argument 
         dictionary.  The dictionary must contain a command string.
 
         """
-        import socket
 
         # set up some defaults for our instance attributes
         self.host = None
         self.port = None
+        self._sock = None
+        self._rcvbuf = None
+        self._sndbuf = None
 
         self._validateArgs(args)     
 
-        # connect to the supplied host and port
+        # connect to the supplied host and port.  buffer sizes are set first
+        # so the TCP window is negotiated with them
         try:
             s = socket.socket()
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self._rcvbuf)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self._sndbuf)
             s.connect((self.host, self.port))
         except socket.error:
+            s.close()
             raise SessionError('Failed to connect to: %s:%s' % 
                 (self.host, str(self.port)))
 
-        # create read/write file handles from the socket 
-        args['writer'] = s.makefile('wb')
+        # commands are small, send them as soon as they are flushed rather
+        # than letting Nagle hold them back
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        # create read/write file handles from the socket.  responses are
+        # read from the socket itself so only the writer needs a real buffer
+        args['writer'] = s.makefile('wb', _WRITE_BUFSIZE)
         args['reader'] = s.makefile('rb')
 
-        # no need to keep the socket around, the file handles are separate 
-        s.close()
+        # keep the socket to receive into a reusable chunk buffer
+        self._sock = s
+        self._chunk = bytearray(_CHUNK_SIZE)
+        self._chunkView = memoryview(self._chunk)
+
+        # call the super class init with the reader and writer to populate
+        # the common session attributes.  the caller never gets a session to
+        # close if that fails, so close the connection here
+        try:
+            super(PortSession, self).__init__(args)
+        except SessionError:
+            self._abandon(args)
+            raise
+
+    # -------------------------------------------------------------------------
+    #    Name: _abandon()
+    #    Args: (dict) args - the args holding the socket's file handles
+    # Returns: n/a
+    #  Raises: n/a
+    #    Desc: Close the file handles and the socket after a failed start.
+    # -------------------------------------------------------------------------
+    def _abandon(self, args):
+        for handle in (args['reader'], args['writer'], self._sock):
+            if handle is None:
+                continue
+            try:
+                handle.close()
+            except (IOError, socket.error):
+                pass
+
+    # -------------------------------------------------------------------------
+    #    Name: _readChunk()
+    #    Args: n/a
+    # Returns: (memoryview) data - output from the session, empty at end of
+    #          file.  Only valid until the next call.
+    #  Raises: socket.error
+    #    Desc: Receive whatever output the session has available straight
+    #          into the session's chunk buffer, saving a string allocation
+    #          per read.
+    # -------------------------------------------------------------------------
+    def _readChunk(self):
+        nbytes = self._sock.recv_into(self._chunk)
+        return self._chunkView[:nbytes]
+
+    def close(self):
+        """Closes the session connections and the socket to the application."""
+
+        super(PortSession, self).close()
 
-        # call the super class init with the reader and writer to populate 
-        # the common session attributes.
-        super(PortSession, self).__init__(args)
+        if self._sock is not None:
+            self._sock.close()
 
 # =============================================================================
 # FACTORY CLASS
@@ -520,12 +954,18 @@ class Session(object):
                 Port Connections:
                   host=(str): Optional connection host.  Default is localhost
                   port=(int): Required port number on the host.
+                  rcvbuf=(int): Optional socket receive buffer size.
+                  sndbuf=(int): Optional socket send buffer size.
                 File Connections:
-                  command=(str): Required command str to execute subprocess.
+                  command=(str|list): Required command to execute subprocess.
                 All Connection Types:
                   language=(str): Required language of the commands.
                   echo=(bool): Optional value to echo the command output. 
                   echoCmd=(bool): Optional value to echo the command itself.
+                  mutating=(str): Optional regex of commands that invalidate
+                    cached responses.
+                  startupTimeout=(float): Optional seconds to wait for the
+                    application to answer.  Default is 30, None waits forever.
 
         Raises:
             SessionError: Raised when any of the following criteria is met:
@@ -537,15 +977,106 @@ class Session(object):
 
         """
     
-        args = kwargs.keys()
-    
-        if 'port' in args:
+        if 'port' in kwargs:
             return PortSession(kwargs)
-        elif 'command' in args:
+        elif 'command' in kwargs:
             return FileSession(kwargs)
         else:
             raise SessionError('Could not determine session type from args.')
 
+# =============================================================================
+# MULTIPLE SESSIONS
+# =============================================================================
+def commandMany(sessionCmds):
+    """Send a command to each of several Sessions and wait on them together.
+
+    Args:
+        (list) sessionCmds: (session, cmd) pairs.  Each session may only
+            appear once.
+
+    Returns:
+        (dict) The output of each command keyed by its session.
+
+    Raises:
+        SessionError: Raised when a session appears more than once, and
+            otherwise under the same criteria as SessionBase.command().
+
+    Sends every command before waiting on any response, then reads from
+    whichever sessions have output ready using select().  Waiting on several
+    applications takes about as long as the slowest of them rather than the
+    sum of all of them.  Echoing and lastCmd/lastResponse behave as if each
+    command had been sent with command().  If one session fails, the
+    responses still owed by the others are read and thrown away before the
+    error is raised so they stay usable.
+
+    """
+
+    sessionCmds = list(sessionCmds)
+
+    # a second command to the same session would leave its responses out of
+    # step with its commands
+    seen = set()
+    for session, cmd in sessionCmds:
+        if session in seen:
+            raise SessionError('Session appears more than once.')
+        seen.add(session)
+
+    outputs = {}
+    pending = OrderedDict()
+    waiting = {}
+    session = None
+
+    try:
+        for session, cmd in sessionCmds:
+            session._preCommand(cmd)
+            session._send('%s\n%s' % (cmd, session._doneCmd))
+            pending[session] = cmd
+
+        for session, cmd in list(pending.items()):
+            try:
+                waiting[session._reader.fileno()] = session
+            except (AttributeError, IOError, ValueError):
+                # nothing to select on, just wait for this one
+                output = session._readResponse()
+                session._postCommand(pending.pop(session), output)
+                outputs[session] = output
+
+        while waiting:
+            # some output may already be buffered from an earlier read
+            for fd, session in list(waiting.items()):
+                output = session._extractResponse()
+                if output is not None:
+                    del waiting[fd]
+                    session._postCommand(pending.pop(session), output)
+                    outputs[session] = output
+
+            if waiting:
+                ready, _, _ = select.select(list(waiting), [], [])
+                for fd in ready:
+                    session = waiting[fd]
+                    session._fillBuffer()
+    except SessionError:
+        pending.pop(session, None)
+        _drainSessions(pending)
+        raise
+
+    return outputs
+
+# -----------------------------------------------------------------------------
+#    Name: _drainSessions()
+#    Args: (list) sessions - sessions each still owed one response
+# Returns: n/a
+#  Raises: n/a
+#    Desc: Read and throw away the response owed by each session.  Sessions
+#          that fail while being drained are left as they are.
+# -----------------------------------------------------------------------------
+def _drainSessions(sessions):
+    for session in sessions:
+        try:
+            session._readResponse(keep=False)
+        except SessionError:
+            pass
+
 # =============================================================================
 
 class SessionError(Exception):